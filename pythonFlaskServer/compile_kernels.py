@@ -0,0 +1,44 @@
+'''
+Compile the tracing kernels of main.py ahead of time into the extension
+module color_robot_kernels, next to this file. When it is present and was
+built from the current main.py, main.py uses it instead of compiling the
+kernels on the first request.
+
+Run it again whenever main.py changes:
+    python compile_kernels.py
+'''
+
+import os
+import sys
+
+from numba.pycc import CC
+
+# The kernels are exported from their Python source, so make sure main.py
+# does not pick up a previously compiled module instead
+sys.modules['color_robot_kernels'] = None
+import main
+
+
+cc = CC('color_robot_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export('followBorders',
+		  'Tuple((i4[:, ::1], i8[::1]))(u1[:, ::1])')(
+	main.followBorders.py_func)
+cc.export('orthogonalLines',
+		  'Tuple((i4[:, ::1], i8[::1]))(u1[:, ::1])')(
+	main.orthogonalLines.py_func)
+cc.export('traceShape',
+		  'Tuple((i4[:, ::1], i8))(u1[:, ::1], b1[:, ::1], i8, i8, i8)')(
+	main.traceShape.py_func)
+
+# Record which version of main.py the kernels were built from
+built = main.sourceHash()
+
+@cc.export('sourceHash', 'i8()')
+def sourceHash():
+	return built
+
+
+if __name__ == '__main__':
+	cc.compile()
@@ -5,17 +5,20 @@ import base64
 import numpy as np
 import io
 import time
+import hashlib
+import threading
+import queue
+from collections import OrderedDict
 from flask import request
 from flask import jsonify
 from flask import Flask
 from flask import send_file
 from flask import send_from_directory
 import flask
-import sys
+from numba import njit, prange
 
 
 app = Flask(__name__)
-sys.setrecursionlimit(10000)
 
 @app.route('/')
 def home():
@@ -41,31 +44,60 @@ def generate():
 	# 		response = {'result': outputfile}
 			time_stamp = int(time.time())
 			locally_copy_of_image_path=f"pic_{time_stamp}.png"
-			image.save(locally_copy_of_image_path ,format="png")
-			paths = imToPaths(locally_copy_of_image_path)
+			if SAVEUPLOADS:
+				image.save(locally_copy_of_image_path ,format="png")
+			paths = imToPaths(image)
 			outfile = locally_copy_of_image_path[:-3]+"gcode"
-			toTextFile(outfile, paths)
-			g_code = None
-			with open(outfile, 'r') as f:
-				g_code = f.read()
-			g_code = g_code_allignment(g_code)
+			g_code = toGCode(paths)
+			keepGCode(outfile, g_code)
 			response = {'result': g_code}
 	return jsonify(response)
 
 
 @app.route('/download/<fname>', methods=['GET'])
 def download(fname):
+	# G code of recent requests is only kept in memory
+	with gcodeLock:
+		g_code = gcodeFiles.get(fname)
+	if g_code is not None:
+		return send_file(io.BytesIO(g_code), download_name=fname)
 	return send_file(fname)
 
 
 # Global constants
 IMDIM = 305         # Pixels in each dimension of image, 305 mm in 12 inches
 SMOOTHERR = 1		# Rounding error when approx. raster with straight lines
+DARKNESS = 127      # Pixels with a grayscale value below this are dark
+TRACER = "border"   # Tracing algorithm for raster images, "border" for
+                    # Suzuki-Abe border following, "orthogonal" for the
+                    # pixel edges of crisp pixel art or "square" for square
+                    # tracing
+RXBUFFER = 64       # Bytes in the serial receive buffer of the Arduino
+ACK = b"17"         # Sent by the Arduino after each line (XON, printed as DEC)
+ACKTIMEOUT = 60     # Seconds to wait for the Arduino to acknowledge a line
+                    # before giving up, longer than any single move
+SAVEUPLOADS = False # Keep a local copy of every image uploaded to /generate
+TILE = 8            # Pixels in each dimension of the tiles searched for shapes
+KEEPFILES = 32      # G code files of recent requests kept for /download
+
+# Steps of the tracing algorithms in each direction (0 = right, 1 = down,
+# 2 = left, 3 = up, since y grows down the image), and to each of the 8
+# neighbours of a pixel in clockwise order, starting on the right
+DX = np.array([1, 0, -1, 0], dtype=np.int8)
+DY = np.array([0, 1, 0, -1], dtype=np.int8)
+MOOREDX = np.array([1, 1, 0, -1, -1, -1, 0, 1], dtype=np.int8)
+MOOREDY = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int8)
 
 # Global variables
-done = []           # Record of all coordinates that were read from the image
-direc = 0           # Current direction for tracing algorithm
-                    # (0 = right, 1 = up, 2 = left, 3 = down)
+gcodeFiles = OrderedDict()  # G code of recent requests, by file name, oldest
+                            # first
+gcodeLock = threading.Lock()
+bufferPool = queue.SimpleQueue() # Arrays for raster images that are not in
+                                 # use, shared by all request threads
+
+# Numba's workqueue threading layer, used when TBB and OpenMP are missing,
+# aborts if two threads run parallel kernels at once
+smoothLock = threading.Lock()
 
 
 def initRaster(filename):
@@ -74,11 +106,15 @@ def initRaster(filename):
     in the local folder.
 
     Arguments:
-        filename is of type string. Contains name of image file.
+        filename is of type string or Image. Contains name of image file, or
+                                             the already opened image.
     '''
 
 	global IMDIM
-	im = Image.open(filename)
+	if isinstance(filename, Image.Image):
+		im = filename.convert('RGB')
+	else:
+		im = Image.open(filename).convert('RGB')
 
 	# Increase contrast of image
 	im = ImageEnhance.Contrast(im)
@@ -92,55 +128,67 @@ def initRaster(filename):
 
 def toTextFile(outfile, shapes):
 	'''
-    Print the coordinates to a text file formatted in G code.
+    Return the coordinates formatted in G code, and print them to a text file.
 
     Arguments:
+        outfile is of type string. Contains name of G code file.
         shapes is of type list. It contains sublists of tuples that correspond
                                 to (x, y) coordinates.
     '''
 
-	file = open(outfile, "w")
+	g_code = toGCode(shapes)
 
-	# Boilerplate text:
-	# G17: Select X, Y plane
-	# G21: Units in millimetres
-	# G90: Absolute distances
-	# G54: Coordinate system 1
-	file.write("G17 G21 G90 G54\n")
+	# Write the whole file at once
+	with open(outfile, "w", buffering=1 << 20) as file:
+		file.write(g_code)
 
-	# Start at origin (0, 0)
-	file.write("G00 X0. Y0.\n")
+	return g_code
 
-	up = True
 
-	# Assume Z0 is down and cutting and Z1 is retracted up
+def toGCode(shapes):
+	'''
+    Return the coordinates formatted in G code. Moves to the first point of
+    each shape are made with the pen up (G00), the rest of the shape is drawn
+    with the pen down (G01).
+
+    Arguments:
+        shapes is of type list. It contains sublists of tuples that correspond
+                                to (x, y) coordinates.
+    '''
+
+	# Start at origin (0, 0)
+	lines = ["G00 X0. Y0."]
+
 	for shape in shapes:
-		for i in range(len(shape)):
-			# If coordinate is an integer, append a decimal point
-			if (shape[i][0] % 1.0 == 0):
-				xstr = str(shape[i][0]) + "."
-			else:
-				xstr = str(shape[i][0])
+		if len(shape) == 0:
+			continue
 
-			if (shape[i][1] % 1.0 == 0):
-				ystr = str(shape[i][1]) + "."
-			else:
-				ystr = str(shape[i][1])
+		# Move to the first point of new shape, then start drawing
+		lines.append("G00 X%s Y%s" % (coordToStr(shape[0][0]), coordToStr(shape[0][1])))
+		lines += ["G01 X%s Y%s" % (coordToStr(x), coordToStr(y)) for x, y in shape[1:]]
 
-			# Write coordinate to file
-			file.write("X" + xstr + " Y" + ystr + "\n")
+	# Return to origin (0, 0) when done
+	lines.append("G00 X0. Y0.\n")
 
-			# When arrived at point of new shape, start cutting
-			if up == True:
-				file.write("Z0.\n")
-				up = False
-		# When finished shape, retract cutter
-		file.write("Z1.\n")
-		up = True
-	# Return to origin (0, 0) when done, then end program with M2
-	file.write("X0. Y0.\nM2")
+	return "\n".join(lines)
 
-	file.close()
+
+def keepGCode(fname, g_code):
+	'''
+    Keep the G code in memory, so it can be downloaded as the file name
+    without writing it to disk. Only the latest KEEPFILES files are kept.
+
+    Arguments:
+        fname is of type string. Contains name of G code file.
+        g_code is of type string. Contains the G code.
+    '''
+
+	with gcodeLock:
+		gcodeFiles[fname] = g_code.encode()
+		gcodeFiles.move_to_end(fname)
+
+		while len(gcodeFiles) > KEEPFILES:
+			gcodeFiles.popitem(last=False)
 
 
 def toSerial(shapes):
@@ -171,47 +219,63 @@ def toSerial(shapes):
 
 	port.baudrate = 4800
 
+	# Wait at most this long for the Arduino to acknowledge each line, after
+	# which it is assumed to be stuck or disconnected
+	port.timeout = ACKTIMEOUT
+
+	# Discard whatever the Arduino printed while starting up
+	port.reset_input_buffer()
+
 	# Boilerplate text:
 	# G17: Select X, Y plane
 	# G21: Units in millimetres
 	# G90: Absolute distances
 	# G54: Coordinate system 1
-	port.write("G17 G21 G90 G54\n".encode())
+	lines = [b"G17 G21 G90 G54\n"]
 
 	# Start at origin (0, 0)
-	port.write("G00 X0. Y0.\n".encode())
+	lines.append(b"G00 X0. Y0.\n")
 
 	up = True
 
 	# Assume Z0 is down and cutting and Z1 is retracted up
 	for shape in shapes:
 		for i in range(len(shape)):
-			# Since the RAM on the Arduino is limited, delay the instructions
-			time.sleep(1)
-
-			# If coordinate is an integer, append a decimal point
-			if (shape[i][0] % 1.0 == 0):
-				xstr = str(shape[i][0]) + "."
-			else:
-				xstr = str(shape[i][0])
-
-			if (shape[i][1] % 1.0 == 0):
-				ystr = str(shape[i][1]) + "."
-			else:
-				ystr = str(shape[i][1])
-
-			# Write coordinate to serial
-			port.write(("X" + xstr + " Y" + ystr + "\n").encode())
+			lines.append(b"X%s Y%s\n" % (coordToStr(shape[i][0]).encode(),
+										  coordToStr(shape[i][1]).encode()))
 
 			# When arrived at point of new shape, start cutting
 			if up == True:
-				port.write(("Z0.\n").encode())
+				lines.append(b"Z0.\n")
 				up = False
 		# When finished shape, retract cutter
-		port.write("Z1.\n".encode())
+		lines.append(b"Z1.\n")
 		up = True
 	# Return to origin (0, 0) when done, then end program with M2
-	port.write("X0. Y0.\nM2".encode())
+	lines.append(b"X0. Y0.\n")
+	lines.append(b"M2\n")
+
+	# Since the RAM on the Arduino is limited, send as many whole lines as fit
+	# in its receive buffer at once, then wait until it acknowledged all of them
+	buf = bytearray()
+	pending = 0
+
+	for line in lines:
+		if len(buf) + len(line) > RXBUFFER:
+			# A chunk sent without the acknowledgements could overflow the
+			# buffer, so stop sending and return False
+			if not sendChunk(port, buf, pending):
+				port.close()
+				return False
+			buf = bytearray()
+			pending = 0
+
+		buf += line
+		pending += 1
+
+	if not sendChunk(port, buf, pending):
+		port.close()
+		return False
 
 	port.close()
 
@@ -219,6 +283,30 @@ def toSerial(shapes):
 	return True
 
 
+def sendChunk(port, buf, pending):
+	'''
+    Write a chunk of G code lines through serial in a single call, then wait
+    until the Arduino acknowledged each of them. Return True if it did, or
+    False if an acknowledgement didn't arrive within ACKTIMEOUT.
+
+    Arguments:
+        port is of type Serial. Contains the port connected to the Arduino.
+        buf is of type bytearray. Contains the whole lines to be sent.
+        pending is of type int. Contains the number of lines in buf.
+    '''
+
+	port.write(buf)
+	port.flush()
+
+	# The Arduino prints XON after every line it processed. On a timeout,
+	# read_until returns whatever arrived so far without the XON.
+	for i in range(pending):
+		if not port.read_until(ACK).endswith(ACK):
+			return False
+
+	return True
+
+
 def initDXF(filename):
 	'''
     Return the DXF text file represented by the file name. The file must be
@@ -245,55 +333,106 @@ def readFromRaster(filename):
     in the image.
 
     Arguments:
-        filename is of type string. Contains name of image file.
+        filename is of type string or Image. Contains name of image file, or
+                                             the already opened image.
     '''
 
-	global done
-
 	# Create Image object from file in local folder
 	im = initRaster(filename)
 
-	# Find first point
-	point = nextShape(im)
+	# Mask of the dark pixels, with one byte per pixel (1 = dark, 0 = white),
+	# and record of all coordinates that were read from the image, both
+	# indexed as [y, x]. Each request has its own pair, so concurrent requests
+	# don't mix.
+	dark, done_mask = rasterBuffers()
+	np.less(np.asarray(im.convert('L')), DARKNESS, out=dark)
+	done_mask.fill(False)
 
-	start = point
-	nextpoint = (0, 0)
+	if TRACER == "border":
+		# Follow every border in the image in a single pass
+		points, ends = followBorders(dark)
 
-	i = 0
-	shapeList = []
+		# An image without dark pixels has no shapes, not a single empty one
+		shapeList = np.split(points, ends[:-1]) if len(ends) else []
+
+	elif TRACER == "orthogonal":
+		# Index of the case of every 2x2 window of pixels around each pixel
+		# corner, with white outside of the image
+		d = np.pad(dark, 1)
+		cases = d[:-1, :-1] | (d[:-1, 1:] << 1) | (d[1:, :-1] << 2) | \
+			(d[1:, 1:] << 3)
 
-	# While there are still shapes in the image
-	while point != (-1, -1):
-		start = point
+		# Link the pixel edges between dark and white into shapes
+		points, ends = orthogonalLines(cases)
+		shapeList = np.split(points, ends[:-1]) if len(ends) else []
 
-		shapeList.append([])
-		shapeList[i].append(point)
+	else:
+		# Literal edge cases: surround the image with white pixels, since the
+		# tracing never goes further than one pixel away from the shape
+		padded = np.pad(dark, 1)
 
-		# While it has not yet fully traced around the image
-		while nextpoint != start:
-			nextpoint = nextPixelInShape(im, point)
-			point = nextpoint
+		# A dark pixel is on the edge if any of its adjacent pixels are not dark
+		d = padded.view(bool)
+		edge = d[1:-1, 1:-1] & \
+			~(d[:-2, 1:-1] & d[2:, 1:-1] & d[1:-1, :-2] & d[1:-1, 2:])
 
-			done.append(point)
-			shapeList[i].append(point)
+		# Coarse map of the tiles of TILE x TILE pixels that contain an edge
+		t = np.pad(edge, ((0, -edge.shape[0] % TILE), (0, -edge.shape[1] % TILE)))
+		tiles = t.reshape(t.shape[0] // TILE, TILE,
+						  t.shape[1] // TILE, TILE).any((1, 3))
 
-		i += 1
-		point = nextShape(im)
+		# Current direction for tracing algorithm, as indexed in DX and DY
+		direc = 0
 
-	# Smooth coordinates in image
-	shapeList = smoothRasterCoords(shapeList)
+		# Find first point
+		point = nextShape(edge, done_mask, tiles)
+
+		shapeList = []
+
+		# While there are still shapes in the image
+		while point != (-1, -1):
+			# Fully trace around the shape, back to its first point
+			trace, direc = traceShape(padded, done_mask, point[0], point[1], direc)
+			shapeList.append([point] + [tuple(px) for px in trace.tolist()])
+
+			point = nextShape(edge, done_mask, tiles)
+
+	# The shapes don't refer to the arrays, so the next request can reuse them.
+	# If tracing fails, they are simply not returned and a new pair is made.
+	bufferPool.put((dark, done_mask))
+
+	# Smooth coordinates in image. The orthogonal lines are already only the
+	# corners where the outline turns, and smoothing them would cut every
+	# pixel step diagonally.
+	if TRACER != "orthogonal":
+		shapeList = smoothRasterCoords(shapeList)
 
 	# Ensure that each shape starts and ends on the same coordinate
 	for i in range(len(shapeList)):
-		if shapeList[i][-1] != shapeList[i][0]:
-			shapeList[i].append(shapeList[i][0])
+		if not np.array_equal(shapeList[i][-1], shapeList[i][0]):
+			shapeList[i] = np.vstack((shapeList[i], shapeList[i][:1]))
 
 	return shapeList
 
 
+def rasterBuffers():
+	'''
+    Return the arrays for the mask of dark pixels and the record of read
+    coordinates of an IMDIM x IMDIM image. They are taken from bufferPool,
+    where they should be put back once done, or allocated if all of them are
+    in use by other requests.
+    '''
+
+	try:
+		return bufferPool.get_nowait()
+	except queue.Empty:
+		return (np.empty((IMDIM, IMDIM), dtype=np.uint8),
+				np.empty((IMDIM, IMDIM), dtype=bool))
+
+
 def readFromDXF(filename):
 	'''
-    Return a list of sublists of tuples which correspond to (x, y) coordinates.
+    Return a list of arrays of (x, y) coordinates, one for each polyline.
     Read the coordinates from a DXF file, treating it as plaintext.
 
     Arguments:
@@ -343,6 +482,9 @@ def readFromDXF(filename):
 
 		line += 1
 
+	# Each shape becomes an array of (x, y) coordinates
+	path = [np.asarray(shape, dtype=np.float64).reshape(-1, 2) for shape in path]
+
 	# Rescale the coordinates to imdim x imdim
 	scale(path)
 
@@ -356,11 +498,14 @@ def imToPaths(filename):
     package.
 
     Arguments:
-        filename is of type string. Contains name of image file.
+        filename is of type string or Image. Contains name of image file, or
+                                             the already opened image.
     '''
 
 	# Read the image as raster or as DXF depending on file extension
-	if filename.endswith((".jpg", ".jpeg", ".png", ".bmp")):
+	if isinstance(filename, Image.Image):
+		coords = readFromRaster(filename)
+	elif filename.endswith((".jpg", ".jpeg", ".png", ".bmp")):
 		coords = readFromRaster(filename)
 	elif filename.endswith(".dxf"):
 		coords = readFromDXF(filename)
@@ -376,39 +521,25 @@ def scale(path):
     be the wrong dimension. Scale the coordinates read from the DXF to IMDIM.
 
     Arguments:
-        path is of type list. Contains sublists of tuples, where each tuple is
-                              an (x, y) coordinate.
+        path is of type list. Contains arrays of (x, y) coordinates, which are
+                              scaled in place.
     '''
 
 	global IMDIM
 
-	# Create lists of only x coordinates and only y coordinates
-	x = []
-	y = []
-
-	for shape in path:
-		for coord in shape:
-			x.append(coord[0])
-			y.append(coord[1])
-
-	# To scale from the old size to imdim, must know the old size
-	maxx = max(x)
-	maxy = max(y)
-
-	minx = min(x)
-	miny = min(y)
+	# All coordinates of all shapes in one array
+	coords = np.concatenate(path)
 
+	# To scale from the old size to imdim, must know the old size.
 	# The distance between the minimal coordinate and the edge is the margin,
 	# assumed size is the maximal coordinate plus the margin
-	margin = min(minx, miny)
-	size = max(maxx, maxy) + margin
+	margin = coords.min()
+	size = coords.max() + margin
 	scale = IMDIM / size
 
 	# Once the old size is known, scale the coordinates
-	for i in range(len(path)):
-		for j in range(len(path[i])):
-			path[i][j][0] *= scale
-			path[i][j][1] *= scale
+	for shape in path:
+		shape *= scale
 
 
 def smoothRasterCoords(coords):
@@ -423,202 +554,479 @@ def smoothRasterCoords(coords):
          |-|      --->      \        AND     o--o--o--o   --->   o--------o
            |-                \
 
+    Each shape is simplified with the Ramer-Douglas-Peucker algorithm, so no
+    removed point is further than SMOOTHERR from the remaining lines.
+
     Arguments:
         coords is of type list. Contains sublists of tuples, where each tuple is
                                 an (x, y) coordinate.
     '''
 
+	shapes = [np.asarray(shape).reshape(-1, 2) for shape in coords]
+	if len(shapes) == 0:
+		return []
+
+	# Pack all shapes into one array, along with the index where each one ends
+	pts = np.concatenate(shapes)
+	ends = np.cumsum([len(shape) for shape in shapes])
+
+	# Keep only the points that the lines need, simplifying shapes in parallel.
+	# Concurrent requests take turns, since each call already uses all cores.
+	with smoothLock:
+		keep = smoothAll(pts.astype(np.float64), ends, SMOOTHERR)
+
 	newCoords = []
+	start = 0
+	for shape, end in zip(shapes, ends):
+		newCoords.append(shape[keep[start:end]])
+		start = end
 
-	# For each shape in coords
-	for s in range(len(coords)):
-		newCoords.append([])
+	return newCoords
 
-		# If it's a simple shape without removable elements, copy it and skip to
-		# the next one
-		if len(coords[s]) <= 2:
-			newCoords[s] = coords[s]
-			continue
 
-		i = 0
+@njit(cache=True, nogil=True, parallel=True)
+def smoothAll(pts, ends, err):
+	'''
+    Return an array of booleans that correspond to whether each point is kept
+    when approximating the shapes with straight lines. The shapes are
+    independent, so they are simplified in parallel.
+
+    Arguments:
+        pts is of type ndarray. Contains the (x, y) coordinates of all shapes.
+        ends is of type ndarray. Contains the index where each shape ends.
+        err is of type float. Contains the maximal distance of a removed point.
+    '''
 
-		# For each point i in the coordinate list
-		while i < len(coords[s]) - 2:
-			j = len(coords[s]) - 1
+	keep = np.zeros(len(pts), np.bool_)
 
-			# For each point j between i and the end of the list
-			while j > i + 1:
-				# List of all points between i and j
-				midpoints = coords[s][i + 1:j]
+	for s in prange(len(ends)):
+		start = 0 if s == 0 else ends[s - 1]
+		if ends[s] > start:
+			keep[start:ends[s]] = simplifyShape(pts[start:ends[s]], err)
 
-				# In usual case, draw line between i and j
-				try:
-					m = (coords[s][j][1] - coords[s][i][1]) / \
-						(coords[s][j][0] - coords[s][i][0])
-					b = coords[s][i][1] - m * coords[s][i][0]
+	return keep
 
-					canDel = True
 
-					for point in midpoints:
-						if linePointDist(m, b, point) >= SMOOTHERR:
-							canDel = False
-							break
+@njit(cache=True, nogil=True)
+def simplifyShape(pts, err):
+	'''
+    Return an array of booleans that correspond to whether each point of the
+    shape is kept when approximating it with straight lines. It is an
+    implementation of the Ramer-Douglas-Peucker algorithm, which works as
+    follows:
+        draw a line between the first and the last point of a segment
+        if the furthest point in between is at least err from the line, keep
+        it and repeat on both halves, otherwise remove all points in between
+
+    Arguments:
+        pts is of type ndarray. Contains the (x, y) coordinates of the shape.
+        err is of type float. Contains the maximal distance of a removed point.
+    '''
 
-					# If all points between i and j are within SMOOTHERR of
-					# the line, remove them
-					if canDel == True:
-						newCoords[s].append(coords[s][i])
-						newCoords[s].append(coords[s][j])
-						i = j
+	# Points in the middle of a straight run are never further from a line
+	# than the ends of the run, so only the ends need to be considered
+	ends = straightRuns(pts)
+	corners = pts[ends]
 
-				# In special case where the line is vertical, m = infinity
-				except ZeroDivisionError:
-					canDel = True
+	n = len(corners)
 
-					for point in midpoints:
-						if abs(coords[s][i][0] - point[0]) >= SMOOTHERR:
-							canDel = False
-							break
+	keep = np.zeros(n, np.bool_)
+	keep[0] = True
+	keep[n - 1] = True
 
-					# If all points between i and j are within SMOOTHERR of
-					# the line, remove them
-					if canDel == True:
-						newCoords[s].append(coords[s][i])
-						newCoords[s].append(coords[s][j])
-						i = j
-				j -= 1
-			i += 1
+	# Segments that are yet to be simplified, as (first, last) indices
+	stack = np.empty((n, 2), np.int64)
+	stack[0, 0] = 0
+	stack[0, 1] = n - 1
+	top = 1
 
-	# If a shape did not have removable points, copy the original coordinates
-	for i in range(len(newCoords)):
-		if len(newCoords[i]) == 0: newCoords[i] = coords[i]
+	while top > 0:
+		top -= 1
+		i = stack[top, 0]
+		j = stack[top, 1]
 
-	return newCoords
+		# If there are no points in between, there is nothing to remove
+		if j - i < 2:
+			continue
+
+		k, d = linePointDist(corners, i, j)
+
+		# If the furthest point is too far from the line, split the segment
+		if d >= err:
+			keep[k] = True
+			stack[top, 0] = i
+			stack[top, 1] = k
+			stack[top + 1, 0] = k
+			stack[top + 1, 1] = j
+			top += 2
+
+	keepAll = np.zeros(len(pts), np.bool_)
+	keepAll[ends[keep]] = True
+	return keepAll
 
 
-def isOnEdge(im, px):
+@njit(cache=True, nogil=True)
+def straightRuns(pts):
 	'''
-    Return a boolean value that corresponds to whether any of the adjacent
-    coordinates are not in the shape, hence whether the current coordinate is on
-    the edge.
+    Return an array of the indices of the points where the shape changes
+    direction, including its first and last point. The shape is read in a
+    single pass: from the start of a run, the run grows point by point until
+    the first point that is not further along the same straight line.
 
     Arguments:
-        im is of type Image. Contains the image which is being processed.
-        px is of type tuple. Contains float elements (x, y) which represent the
-                             coordinate being checked.
+        pts is of type ndarray. Contains the (x, y) coordinates of the shape.
     '''
 
-	hues = []
+	n = len(pts)
 
-	# Literal edge cases
-	try:
-		hues.append(sum(im.getpixel((px[0] - 1, px[1]))))
-	except IndexError:
-		hues.append(sum((255, 255, 255)))
+	ends = np.empty(n, np.int64)
+	ends[0] = 0
+	m = 1
 
-	try:
-		hues.append(sum(im.getpixel((px[0], px[1] - 1))))
-	except IndexError:
-		hues.append(sum((255, 255, 255)))
+	i = 0
+	while i < n - 1:
+		# Direction of the run
+		dx = pts[i + 1, 0] - pts[i, 0]
+		dy = pts[i + 1, 1] - pts[i, 1]
 
-	try:
-		hues.append(sum(im.getpixel((px[0] + 1, px[1]))))
-	except IndexError:
-		hues.append(sum((255, 255, 255)))
+		j = i + 1
+		along = dx * dx + dy * dy
 
-	try:
-		hues.append(sum(im.getpixel((px[0], px[1] + 1))))
-	except IndexError:
-		hues.append(sum((255, 255, 255)))
+		while j < n - 1:
+			ex = pts[j + 1, 0] - pts[i, 0]
+			ey = pts[j + 1, 1] - pts[i, 1]
 
-	if (max(hues) > sum((127, 127, 127))):
-		return True
-	else:
-		return False
+			# Stop at the first point off the line, or not further along it
+			if dx * ey - dy * ex != 0 or dx * ex + dy * ey <= along:
+				break
+
+			along = dx * ex + dy * ey
+			j += 1
+
+		ends[m] = j
+		m += 1
+		i = j
 
+	return ends[:m]
 
-def nextPixelInShape(im, px):
+
+@njit(cache=True, nogil=True)
+def traceShape(padded, done_mask, x, y, direc):
 	'''
-    Return a tuple which represents the next coordinate when proceeding
-    clockwise around a shape. It is an implementation of the square tracing
+    Return an array of the (x, y) coordinates met when proceeding clockwise
+    around a shape, starting from (x, y) and ending back on it, along with
+    the final direction. It is an implementation of the square tracing
     algorithm, which works as follows:
         if on a black square, turn left of previous direction and go forward
         if on a white square, turn right of previous direction and go forward
 
     Arguments:
-        im is of type Image. Contains the image which is being processed.
-        px is of type tuple. Contains float elements (x, y) which represent the
-                             current coordinate.
+        padded is of type ndarray. Contains 1 for the dark pixels and 0 for
+                                   the white ones, indexed as [y + 1, x + 1],
+                                   with a border of white pixels around the
+                                   image.
+        done_mask is of type ndarray. Contains booleans, indexed as [y, x],
+                                      that correspond to whether each
+                                      coordinate was already read.
+        x, y are of type int. Represent the first coordinate of the shape.
+        direc is of type int. Contains the current direction.
     '''
 
-	global direc, done
+	height = padded.shape[0] - 2
+	width = padded.shape[1] - 2
 
-	pixels = im.load()
+	# Most shapes are small, so start with a short array and grow it as needed
+	trace = np.empty((256, 2), np.int32)
+	n = 0
 
-	try:
-		pixel = pixel = sum(im.getpixel((px[0], px[1])))
-	except IndexError:
-		pixel = sum((255, 255, 255))
+	startx, starty = x, y
 
-	# 0 = right, 1 = up, 2 = left, 3 = down
-	if pixel < sum((127, 127, 127)):
-		direc = (direc - 1) % 4
-	else:
-		direc = (direc + 1) % 4
-
-	# Implementation of description in docstring
-	if direc == 0:
-		x = px[0] + 1
-		y = px[1]
-	elif direc == 1:
-		x = px[0]
-		y = px[1] + 1
-	elif direc == 2:
-		x = px[0] - 1
-		y = px[1]
-	elif direc == 3:
-		x = px[0]
-		y = px[1] - 1
+	# Each pixel can be entered at most once from every direction
+	while n < 4 * height * width:
+		# Implementation of description in docstring: turn left (-1) on a
+		# dark pixel and right (+1) on a white one, without branching
+		direc = (direc + 1 - 2 * np.int64(padded[y + 1, x + 1])) & 3
 
-	try:
-		pixel = sum(im.getpixel((x, y)))
-	except IndexError:
-		pixel = sum((255, 255, 255))
-
-	# Since this function returns the next pixel, it can't return an off-shape
-	# white pixel. It recurses until it finds a black pixel, which it returns.
-	if pixel < sum((127, 127, 127)):
-		if (x, y) not in done:
-			done.append((x, y))
-		return (x, y)
-	else:
-		return nextPixelInShape(im, (x, y))
+		x += DX[direc]
+		y += DY[direc]
+
+		# Only the dark pixels belong to the outline of the shape
+		if padded[y + 1, x + 1]:
+			done_mask[y, x] = True
+			trace = addPoint(trace, n, x, y)
+			n += 1
+
+			if x == startx and y == starty:
+				break
 
+	return trace[:n], direc
 
-def nextShape(im):
+
+def nextShape(edge, done_mask, tiles):
 	'''
     Return a tuple which represents the leftmost point of the next shape.
 
     Arguments:
-        im is of type Image. Contains the image which is being processed.
+        edge is of type ndarray. Contains booleans, indexed as [y, x], that
+                                 correspond to whether each pixel is dark and
+                                 on the edge of a shape.
+        done_mask is of type ndarray. Contains booleans, indexed as [y, x],
+                                      that correspond to whether each
+                                      coordinate was already read.
+        tiles is of type ndarray. Contains booleans, indexed as [y, x], that
+                                  correspond to whether each tile of TILE x
+                                  TILE pixels may contain an edge that was not
+                                  read yet. Updated as tiles are searched.
     '''
 
-	global IMDIM, done
+	# Only search the columns of tiles that may still contain a new shape
+	for tx in np.flatnonzero(tiles.any(0)):
+		x0 = tx * TILE
+		candidates = edge[:, x0:x0 + TILE] & ~done_mask[:, x0:x0 + TILE]
+
+		# Forget the tiles of this column where every edge was already read
+		c = np.pad(candidates, ((0, -len(candidates) % TILE),
+								(0, TILE - candidates.shape[1])))
+		tiles[:, tx] = c.reshape(-1, TILE * TILE).any(1)
 
-	# Check the brightness of every point in the image
-	for x in range(IMDIM):
-		for y in range(IMDIM):
+		# Scan column by column, so transpose the candidates to [x, y]
+		idx = np.argwhere(candidates.T)
 
-			# If a dark pixel is found that was not already read, return it
-			if sum(im.getpixel((x, y))) < sum((127, 127, 127)) and \
-					isOnEdge(im, (x, y)) and not (x, y) in done:
-				done.append((x, y))
-				return (x, y)
+		# If a dark pixel is found that was not already read, return it
+		if len(idx) > 0:
+			x, y = x0 + int(idx[0][0]), int(idx[0][1])
+			done_mask[y, x] = True
+			return (x, y)
 
 	# If no shape is found, return a special tuple
 	return (-1, -1)
 
 
+@njit(cache=True, nogil=True)
+def followBorders(dark):
+	'''
+    Return the (x, y) coordinates of the outline of every shape in the image,
+    packed into one array, and an array with the index where each outline
+    ends. It is an implementation of the Suzuki-Abe border following
+    algorithm, which works as follows:
+        scan the image row by row for a dark pixel next to a white one, which
+        starts an outer border (white on its left) or a hole (white on its
+        right) that was not followed yet
+        follow the border counterclockwise by looking at the 8 neighbours of
+        the current pixel, starting next to the previous one
+        mark the followed pixels, so each border is only followed once
+
+    Arguments:
+        dark is of type ndarray. Contains 1 for the dark pixels and 0 for the
+                                 white ones, indexed as [y, x].
+    '''
+
+	height, width = dark.shape
+
+	# 0 = white, 1 = dark, 2 = followed, -2 = followed with white on its
+	# right. Pad with white so the literal edge cases need no checks.
+	f = np.zeros((height + 2, width + 2), np.int8)
+	for y in range(height):
+		for x in range(width):
+			if dark[y, x]:
+				f[y + 1, x + 1] = 1
+
+	points = np.empty((height * width, 2), np.int32)
+	ends = np.empty(height * width, np.int64)
+	n = 0
+	shapes = 0
+
+	for i in range(1, height + 1):
+		for j in range(1, width + 1):
+			# Outer border starts with white on the left, a hole with white on
+			# the right
+			if f[i, j] == 1 and f[i, j - 1] == 0:
+				d = 4
+			elif f[i, j] >= 1 and f[i, j + 1] == 0:
+				d = 0
+			else:
+				continue
+
+			# Look clockwise for any neighbour of the first pixel
+			first = -1
+			for k in range(8):
+				if f[i + MOOREDY[(d + k) & 7], j + MOOREDX[(d + k) & 7]] != 0:
+					first = (d + k) & 7
+					break
+
+			# Lone pixel
+			if first == -1:
+				f[i, j] = -2
+				points = addPoint(points, n, j - 1, i - 1)
+				n += 1
+
+			else:
+				i1 = i + MOOREDY[first]
+				j1 = j + MOOREDX[first]
+				i3 = i
+				j3 = j
+
+				# Direction from the current pixel to the previous one
+				d = first
+
+				while True:
+					# Look counterclockwise for the next pixel of the border,
+					# starting next to the previous one
+					rightWhite = False
+					for k in range(1, 9):
+						d4 = (d - k) & 7
+						if f[i3 + MOOREDY[d4], j3 + MOOREDX[d4]] != 0:
+							break
+						if d4 == 0:
+							rightWhite = True
+
+					if rightWhite:
+						f[i3, j3] = -2
+					elif f[i3, j3] == 1:
+						f[i3, j3] = 2
+
+					points = addPoint(points, n, j3 - 1, i3 - 1)
+					n += 1
+
+					i4 = i3 + MOOREDY[d4]
+					j4 = j3 + MOOREDX[d4]
+
+					# Back to the start, heading the same way
+					if i4 == i and j4 == j and i3 == i1 and j3 == j1:
+						break
+
+					i3 = i4
+					j3 = j4
+					d = (d4 + 4) & 7
+
+			# Each shape ends on the coordinate it starts with
+			points = addPoint(points, n, j - 1, i - 1)
+			n += 1
+
+			ends[shapes] = n
+			shapes += 1
+
+	return points[:n].copy(), ends[:shapes].copy()
+
+
+@njit(cache=True, nogil=True)
+def orthogonalLines(cases):
+	'''
+    Return the corners of the outline of every shape in the image, packed into
+    one array, and an array with the index where each outline ends. The
+    outlines follow the edges of the pixels, so each shape is a polygon of
+    horizontal and vertical lines. It works as follows:
+        every pixel corner is given one of 16 cases, depending on which of
+        the 4 pixels around it are dark
+        the case tells which edge to follow out of the corner, so that the
+        dark pixel is on the right
+        follow the edges from corner to corner until back to the first one,
+        keeping only the corners where the direction changes
+
+    Arguments:
+        cases is of type ndarray. Contains the case of each pixel corner,
+                                  indexed as [y, x], where the bits 1, 2, 4
+                                  and 8 correspond to whether the top left,
+                                  top right, bottom left and bottom right
+                                  pixels are dark.
+    '''
+
+	height, width = cases.shape
+
+	# Edge to follow out of a corner for each case, as a direction of DX and
+	# DY. Cases 6 and 9 are saddles, with two dark pixels on a diagonal, where
+	# both edges are used: turn right to keep the dark pixels apart.
+	follow = (-1, 2, 3, 2, 1, 1, -1, 1, 0, -1, 3, 2, 0, 0, 3, -1)
+
+	# Bits of the edges that were already followed out of each corner
+	used = np.zeros((height, width), np.uint8)
+
+	points = np.empty((height * width, 2), np.int32)
+	ends = np.empty(height * width, np.int64)
+	n = 0
+	shapes = 0
+
+	for y in range(height):
+		for x in range(width):
+			case = cases[y, x]
+			if case == 0 or case == 15:
+				continue
+
+			for direc in range(4):
+				# Literal edge cases: saddles may start both of their edges
+				if case == 6:
+					if direc != 1 and direc != 3:
+						continue
+				elif case == 9:
+					if direc != 0 and direc != 2:
+						continue
+				elif direc != follow[case]:
+					continue
+
+				if used[y, x] & (1 << direc):
+					continue
+
+				# The first corner of a shape is always one where it turns
+				points = addPoint(points, n, x, y)
+				n += 1
+
+				cx = x
+				cy = y
+				d = direc
+
+				while True:
+					used[cy, cx] |= 1 << d
+					cx += DX[d]
+					cy += DY[d]
+
+					if cases[cy, cx] == 6 or cases[cy, cx] == 9:
+						nextd = (d + 1) & 3
+					else:
+						nextd = follow[cases[cy, cx]]
+
+					# Back to the first edge
+					if cx == x and cy == y and nextd == direc:
+						break
+
+					# Only keep the corners where the shape turns
+					if nextd != d:
+						points = addPoint(points, n, cx, cy)
+						n += 1
+
+					d = nextd
+
+				# Each shape ends on the coordinate it starts with
+				points = addPoint(points, n, x, y)
+				n += 1
+
+				ends[shapes] = n
+				shapes += 1
+
+	return points[:n].copy(), ends[:shapes].copy()
+
+
+@njit(cache=True, nogil=True)
+def addPoint(points, n, x, y):
+	'''
+    Return the points array with (x, y) stored at index n. If the array is
+    full, a copy twice as long is returned instead.
+
+    Arguments:
+        points is of type ndarray. Contains (x, y) coordinates.
+        n is of type int. Contains the number of coordinates in points.
+        x, y are of type int. Represent the coordinate to add.
+    '''
+
+	if n == points.shape[0]:
+		grown = np.empty((2 * n, 2), points.dtype)
+		grown[:n] = points
+		points = grown
+
+	points[n, 0] = x
+	points[n, 1] = y
+	return points
+
+
 def dist(a, b):
 	'''
     Return the Pythagorean distance between two points.
@@ -630,40 +1038,90 @@ def dist(a, b):
 	return ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5
 
 
-def linePointDist(m, b, p):
+def coordToStr(c):
+	'''
+    Return the coordinate formatted for G code. If it is an integer, a decimal
+    point is appended.
+
+    Arguments:
+        c is of type float. Represents an x or y coordinate.
+    '''
+
+	if (c % 1.0 == 0):
+		return "%d." % c
+	else:
+		return str(c)
+
+
+@njit(cache=True, nogil=True)
+def linePointDist(pts, i, j):
 	'''
-    Return the distance between a point and a line.
+    Return the index of the point between points i and j which is the
+    furthest from the line through them, along with its distance.
 
     Arguments:
-        m, b are of type float. Represent slope and y-intercept of line.
-        p is of type tuple. Represents (x, y) coordinates.
+        pts is of type ndarray. Contains the (x, y) coordinates of the shape.
+        i, j are of type int. Contains the indices of the ends of the line.
     '''
 
-	n = (m * p[0] - p[1] + b)
-	d = (m ** 2 + 1) ** 0.5
-	return abs(n / d)
+	x0 = pts[i, 0]
+	y0 = pts[i, 1]
+	dx = pts[j, 0] - x0
+	dy = pts[j, 1] - y0
 
+	# The norm of the line is the same for every point, so compute it once
+	d = np.sqrt(dx * dx + dy * dy)
 
-def g_code_allignment(g_code):
-	pen_up = True
-	lines = g_code.split('\n')
-	new_g_code = ['G00 X0. Y0.']
-	for line in lines:
-		if line.startswith('Z0'):
-			pen_up = False
-			continue
-		elif line.startswith('Z1'):
-			pen_up = True
-			continue
-		elif line.startswith('X'):
-			prefix = 'G00 ' if pen_up else 'G01 '
-			new_line = prefix + line
-			new_g_code += [new_line]
+	furthest = i + 1
+	maxn = -1.0
+
+	for k in range(i + 1, j):
+		# In usual case, distance to the line through i and j
+		if d > 0:
+			n = abs(dx * (pts[k, 1] - y0) - dy * (pts[k, 0] - x0))
+		# In special case where i and j are the same point (a closed shape),
+		# distance to that point
 		else:
-			continue
-	new_g_code += ["G00 X0. Y0.\n"]
-	new_g_code = '\n'.join(new_g_code)
-	return new_g_code
+			n = np.sqrt((pts[k, 0] - x0) ** 2 + (pts[k, 1] - y0) ** 2)
+
+		if n > maxn:
+			maxn = n
+			furthest = k
+
+	if d > 0:
+		return furthest, maxn / d
+	else:
+		return furthest, maxn
+
+
+def sourceHash():
+	'''
+    Return a hash of the source of this file, which the kernels compiled ahead
+    of time by compile_kernels.py record to tell which version they were built
+    from.
+    '''
+
+	with open(__file__, 'rb') as file:
+		digest = hashlib.sha1(file.read()).hexdigest()
+
+	return int(digest[:15], 16)
+
+
+# Use the tracing kernels compiled ahead of time by compile_kernels.py, if
+# available, so the first request doesn't wait for them to be compiled
+try:
+	import color_robot_kernels
+except ImportError:
+	color_robot_kernels = None
+
+# Kernels built from another version of this file may behave differently or
+# take other arguments, so keep the JIT kernels unless the source matches
+if hasattr(color_robot_kernels, "sourceHash") and \
+		color_robot_kernels.sourceHash() == sourceHash():
+	followBorders = color_robot_kernels.followBorders
+	orthogonalLines = color_robot_kernels.orthogonalLines
+	traceShape = color_robot_kernels.traceShape
+
 
 # export FLASK_APP="main.py"
 # export FLASK_DEV="development"